@@ -13,14 +13,21 @@ infrastructure. All is needed for this plugin is a working MySQL server.
 
 The module requires the database (default ``salt_cache``) to exist but creates
 its own table if needed. The keys are indexed using the ``bank`` and
-``etcd_key`` columns.
+``etcd_key`` columns. Only fetching a value reads the ``data`` column, listing
+keys and checking for their existence or update time never touch the stored
+values.
 
 To enable this cache plugin, the master will need the python client for
-MySQL installed. This can be easily installed with pip:
+MySQL installed. The C based ``mysqlclient`` is recommended, as it is
+considerably faster for the many small queries a cache runs. This can be
+easily installed with pip:
 
 .. code-block:: bash
 
-    pip install pymysql
+    pip install mysqlclient
+
+The pure Python ``pymysql`` is used as a fallback if ``mysqlclient`` is not
+available, which logs a warning unless ``mysql.driver`` is set to ``pymysql``.
 
 Optionally, depending on the MySQL agent configuration, the following values
 could be set in the master config. These are the defaults:
@@ -35,6 +42,39 @@ could be set in the master config. These are the defaults:
     mysql.table_name: cache
     # This may be enabled to create a fresh connection on every call
     mysql.fresh_connection: false
+    # Maximum number of connections opened at the same time
+    mysql.pool_size: 10
+    # Check idle pooled connections before handing them out
+    mysql.ping_on_checkout: false
+    # Serialize with plain msgpack where possible, falling back to
+    # salt.payload for types msgpack does not support. Either way, the data
+    # is stored and read back the same way salt.payload does.
+    mysql.raw_msgpack: true
+    # Queue writes and store them in batches from a background thread.
+    # Reads and flushes wait for the writes queued by the same process,
+    # other processes might not see the values right after they have been
+    # stored.
+    mysql.async_store: false
+    # Maximum number of rows per batch, and how long to wait for a batch
+    # to fill up
+    mysql.batch_size: 128
+    mysql.batch_ms: 5
+    # Keep up to read_cache_size fetched values in memory for read_cache_ttl
+    # seconds. Disabled by default, as other processes' writes only become
+    # visible once a value expires.
+    mysql.read_cache_size: 1024
+    mysql.read_cache_ttl: 0
+    # Flushing a bank deletes at most this many rows per query
+    mysql.flush_chunk: 10000
+    # The expected client library, either mysqlclient or pymysql
+    mysql.driver: mysqlclient
+    # Move all objects alive after the client setup to the permanent GC
+    # generation, so later collections do not have to scan them. This
+    # affects the whole process, objects allocated later are unaffected.
+    mysql.gc_freeze: false
+    # Compress stored values with zstd, requires the zstandard library.
+    # Values stored uncompressed remain readable and vice versa.
+    mysql.compression: None
 
 To use the mysql as a minion data cache backend, set the master ``cache`` config
 value to ``mysql``:
@@ -47,12 +87,18 @@ value to ``mysql``:
 .. _`MySQL documentation`: https://github.com/coreos/mysql
 """
 
-import copy
+import atexit
+import collections
+import contextlib
+import gc
 import logging
+import os
+import queue
+import random
+import threading
 import time
 
-import salt.payload
-import salt.utils.stringutils
+import salt.utils.msgpack
 from salt.exceptions import SaltCacheError
 
 try:
@@ -81,13 +127,44 @@ except ImportError:
     except ImportError:
         MySQLdb = None
 
+try:
+    import zstandard
+
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
 
 _DEFAULT_DATABASE_NAME = "salt_cache"
 _DEFAULT_CACHE_TABLE_NAME = "cache"
 _RECONNECT_INTERVAL_SEC = 0.050
+_RECONNECT_MAX_INTERVAL_SEC = 2.0
+_DEFAULT_POOL_SIZE = 10
+_DEFAULT_BATCH_SIZE = 128
+_DEFAULT_BATCH_MS = 5
+_DEFAULT_READ_CACHE_SIZE = 1024
+_DEFAULT_FLUSH_CHUNK = 10000
+# Prefix of compressed values. A msgpack value never starts with it, as the
+# single positive integer "z" would not be followed by any more data.
+_ZSTD_MAGIC = b"zstd1"
+_ZSTD_LEVEL = 3
 
 log = logging.getLogger(__name__)
 
+# Serializes starting the background writer, so concurrent first writes
+# share a single queue
+_write_queue_lock = threading.Lock()
+
+
+def _reset_write_queue_lock():
+    # A thread holding the lock while the process forks never releases it
+    # in the child
+    global _write_queue_lock  # pylint: disable=global-statement
+    _write_queue_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_write_queue_lock)
+
 # Module properties
 
 __virtualname__ = "mysql"
@@ -101,60 +178,335 @@ def __virtual__():
     return bool(MySQLdb), "No python mysql client installed." if MySQLdb is None else ""
 
 
+class _ConnectionPool:
+    """
+    Bounded pool of MySQL connections.
+
+    At most ``size`` connections are checked out at the same time, further
+    callers block until one is handed back. Returned connections are kept
+    for reuse unless ``keep_idle`` is false, in which case they are closed.
+    """
+
+    def __init__(self, connect_kwargs, size=_DEFAULT_POOL_SIZE, keep_idle=True, ping=False):
+        self._connect_kwargs = connect_kwargs
+        self._keep_idle = keep_idle
+        self._ping = ping
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of the ``with`` block.
+        """
+        with self._slots:
+            conn = self._checkout()
+            try:
+                yield conn
+            except BaseException:
+                # The connection is in an unknown state, do not reuse it
+                self._discard(conn)
+                raise
+            if self._keep_idle:
+                self._idle.put(conn)
+            else:
+                self._discard(conn)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    def _checkout(self):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            log.debug("mysql_cache: creating db connection")
+            return MySQLdb.connect(**self._connect_kwargs)
+        if self._ping:
+            try:
+                conn.ping()
+            except (OperationalError, InterfaceError) as e:
+                log.info("mysql_cache: recreating stale db connection due to: %r", e)
+                self._discard(conn)
+                return MySQLdb.connect(**self._connect_kwargs)
+        return conn
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+
+class _ReadCache:
+    """
+    Thread-safe LRU cache of values read from the database, whose entries
+    expire ``ttl`` seconds after being set.
+
+    Entries are keyed by ``(kind, bank, key)`` tuples.
+    """
+
+    _KINDS = ("fetch", "updated")
+
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entry):
+        """
+        Return the cached value for ``entry``, or None.
+        """
+        with self._lock:
+            try:
+                expires, value = self._entries[entry]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._entries[entry]
+                return None
+            self._entries.move_to_end(entry)
+            return value
+
+    def set(self, entry, value):
+        """
+        Cache ``value`` for ``entry``, evicting the least recently used
+        entries if needed.
+        """
+        with self._lock:
+            self._entries[entry] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(entry)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, bank, key=None):
+        """
+        Drop the entries of ``key`` in ``bank``, or of the whole bank.
+        """
+        with self._lock:
+            if key is not None:
+                for kind in self._KINDS:
+                    self._entries.pop((kind, bank, key), None)
+                return
+            for entry in list(self._entries):
+                if entry[1] == bank:
+                    del self._entries[entry]
+
+
+class _GCPause:
+    """
+    Context manager disabling the garbage collector while any thread is
+    inside it. The collector is only enabled again by the last thread to
+    leave, and only if it was enabled to begin with.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._reenable = False
+
+    def __enter__(self):
+        with self._lock:
+            if not self._depth:
+                self._reenable = gc.isenabled()
+                gc.disable()
+            self._depth += 1
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._depth -= 1
+            if not self._depth and self._reenable:
+                gc.enable()
+
+
+_gc_pause = _GCPause()
+
+
 def force_reconnect():
     """
-    Force a reconnection to the MySQL database, by removing the client from
-    Salt's __context__.
+    Force a reconnection to the MySQL database, by closing the idle pooled
+    connections and removing the pool from Salt's __context__.
     """
-    __context__.pop("mysql_client", None)
+    __context__.pop("mysql_ready", None)
+    pool = __context__.pop("mysql_pool", None)
+    if pool is not None:
+        pool.close()
 
 
-def run_query(conn, query, args=None, retries=3):
+def _get_pool():
     """
-    Get a cursor and run a query. Reconnect up to ``retries`` times if
-    needed.
-    Returns: cursor, affected rows counter
-    Raises: SaltCacheError, AttributeError, OperationalError, InterfaceError
+    Return the connection pool, creating it if needed.
     """
-    if __context__.get("mysql_fresh_connection"):
-        # Create a new connection if configured
-        conn = MySQLdb.connect(**__context__["mysql_kwargs"])
-        __context__["mysql_client"] = conn
-    if conn is None:
-        conn = __context__.get("mysql_client")
-    try:
-        cur = conn.cursor()
+    pool = __context__.get("mysql_pool")
+    if pool is None:
+        pool = _ConnectionPool(
+            __context__["mysql_kwargs"],
+            size=__context__.get("mysql_pool_size", _DEFAULT_POOL_SIZE),
+            keep_idle=not __context__.get("mysql_fresh_connection"),
+            ping=__context__.get("mysql_ping_on_checkout", False),
+        )
+        __context__["mysql_pool"] = pool
+    return pool
 
-        if not args:
-            log.debug("Doing query: %s", query)
-            out = cur.execute(query)
-        else:
-            log.debug("Doing query: %s args: %s ", query, repr(args))
-            out = cur.execute(query, args)
 
-        return cur, out
-    except (AttributeError, OperationalError, InterfaceError) as e:
-        if retries == 0:
-            raise
-        # reconnect creating new client
-        time.sleep(_RECONNECT_INTERVAL_SEC)
-        if conn is None:
-            log.debug("mysql_cache: creating db connection")
-        else:
+def _reconnect_delay(attempt):
+    """
+    Return how long to wait before reconnect attempt number ``attempt``.
+    The delay grows exponentially and is jittered, so workers hitting the
+    same outage do not all reconnect at once.
+    """
+    delay = min(_RECONNECT_MAX_INTERVAL_SEC, _RECONNECT_INTERVAL_SEC * 2**attempt)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def run_query(conn, query, args=None, retries=3, cursor_class=None):
+    """
+    Get a cursor and run a query. If ``conn`` is None, a connection is
+    checked out from the pool for the duration of the query. Reconnect up
+    to ``retries`` times if needed.
+    The result set is read and the cursor closed before the connection is
+    handed back, as closing a cursor may still talk to the server.
+    Returns: result rows, affected rows counter
+    Raises: SaltCacheError
+    """
+    for attempt in range(retries + 1):
+        try:
+            if conn is None:
+                checkout = _get_pool().connection()
+            else:
+                checkout = contextlib.nullcontext(conn)
+            with checkout as conn:
+                cur = conn.cursor(cursor_class) if cursor_class else conn.cursor()
+                try:
+                    if not args:
+                        log.debug("Doing query: %s", query)
+                        out = cur.execute(query)
+                    else:
+                        if log.isEnabledFor(logging.DEBUG):
+                            log.debug("Doing query: %s args: %r", query, _loggable_args(args))
+                        out = cur.execute(query, args)
+                    # Only queries returning rows have a description
+                    rows = cur.fetchall() if cur.description else ()
+                finally:
+                    cur.close()
+
+                return rows, out
+        except (AttributeError, OperationalError, InterfaceError) as e:
+            if attempt == retries:
+                raise SaltCacheError(_query_error(query, args, e)) from e
+            time.sleep(_reconnect_delay(attempt))
             log.info("mysql_cache: recreating db connection due to: %r", e)
-        __context__["mysql_client"] = MySQLdb.connect(**__context__["mysql_kwargs"])
-        return run_query(
-            conn=__context__.get("mysql_client"),
-            query=query,
-            args=args,
-            retries=(retries - 1),
-        )
-    except Exception as e:  # pylint: disable=broad-except
-        if len(query) > 150:
-            query = query[:150] + "<...>"
-        raise SaltCacheError(
-            "Error running {}{}: {}".format(query, f"- args: {args}" if args else "", e)
-        ) from e
+            # retry on a new pooled connection, the failed one has been discarded
+            conn = None
+        except Exception as e:  # pylint: disable=broad-except
+            raise SaltCacheError(_query_error(query, args, e)) from e
+
+
+def _loggable_args(args):
+    """
+    Return the query ``args`` with binary values replaced by their size, to
+    keep serialized cache data out of logs and error messages.
+    """
+    return tuple(f"<{len(arg)} bytes>" if isinstance(arg, bytes) else arg for arg in args)
+
+
+def _query_error(query, args, exc):
+    """
+    Return the error message for a failed query.
+    """
+    if len(query) > 150:
+        query = query[:150] + "<...>"
+    return "Error running {}{}: {}".format(
+        query, f"- args: {_loggable_args(args)}" if args else "", exc
+    )
+
+
+def _writer(pool, query, write_queue, batch_size, batch_interval, retries=3):
+    """
+    Store the rows put on ``write_queue`` in batches of up to ``batch_size``
+    rows, waiting at most ``batch_interval`` seconds for a batch to fill up.
+    """
+    while True:
+        rows = [write_queue.get()]
+        deadline = time.monotonic() + batch_interval
+        while len(rows) < batch_size:
+            try:
+                rows.append(write_queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+
+        for attempt in range(retries + 1):
+            try:
+                with pool.connection() as conn:
+                    cur = conn.cursor()
+                    log.debug("Doing query: %s with %d rows", query, len(rows))
+                    cur.executemany(query, rows)
+                    cur.close()
+                break
+            except (AttributeError, OperationalError, InterfaceError) as e:
+                if attempt == retries:
+                    log.error("mysql_cache: failed to store %d entries: %r", len(rows), e)
+                else:
+                    time.sleep(_reconnect_delay(attempt))
+                    log.info("mysql_cache: recreating db connection due to: %r", e)
+            except Exception as e:  # pylint: disable=broad-except
+                log.error("mysql_cache: failed to store %d entries: %r", len(rows), e)
+                break
+
+        for _ in rows:
+            write_queue.task_done()
+
+
+def _get_write_queue():
+    """
+    Return the queue of pending writes, starting the writer thread if needed.
+    """
+    pid, write_queue = __context__.get("mysql_write_queue", (None, None))
+    # The writer thread does not survive a fork
+    if pid == os.getpid():
+        return write_queue
+    with _write_queue_lock:
+        pid, write_queue = __context__.get("mysql_write_queue", (None, None))
+        if pid == os.getpid():
+            return write_queue
+        write_queue = queue.Queue()
+        threading.Thread(
+            target=_writer,
+            args=(
+                _get_pool(),
+                __context__["mysql_queries"]["store"],
+                write_queue,
+                __context__.get("mysql_batch_size", _DEFAULT_BATCH_SIZE),
+                __context__.get("mysql_batch_ms", _DEFAULT_BATCH_MS) / 1000,
+            ),
+            name="mysql_cache-writer",
+            daemon=True,
+        ).start()
+        # Do not lose the pending writes on a clean shutdown
+        atexit.register(write_queue.join)
+        __context__["mysql_write_queue"] = (os.getpid(), write_queue)
+    return write_queue
+
+
+def _wait_for_writes():
+    """
+    Block until the writes queued by this process have been stored, so
+    reads and flushes are not overtaken by them.
+    """
+    if not __context__.get("mysql_async_store"):
+        return
+    pid, write_queue = __context__.get("mysql_write_queue", (None, None))
+    if pid == os.getpid():
+        write_queue.join()
 
 
 def _create_table():
@@ -162,34 +514,26 @@ def _create_table():
     Create table if needed
     """
     # Explicitly check if the table already exists as the library logs a
-    # warning on CREATE TABLE
-    query = """SELECT COUNT(TABLE_NAME) FROM information_schema.tables
-        WHERE table_schema = %s AND table_name = %s"""
-    cur, _ = run_query(
-        __context__.get("mysql_client"),
+    # warning on CREATE TABLE. Look up whether the last_update column exists
+    # in the same round trip.
+    query = """
+    SELECT
+        COUNT(COLUMN_NAME),
+        COUNT(CASE WHEN COLUMN_NAME = 'last_update' THEN 1 END)
+    FROM
+        information_schema.columns
+    WHERE
+        table_schema = %s
+        AND table_name = %s
+    """
+    rows, _ = run_query(
+        None,
         query,
         args=(__context__["mysql_kwargs"]["db"], __context__["mysql_table_name"]),
     )
-    r = cur.fetchone()
-    cur.close()
-    if r[0] == 1:
-        query = """
-        SELECT COUNT(TABLE_NAME)
-        FROM
-            information_schema.columns
-        WHERE
-            table_schema = %s
-            AND table_name = %s
-            AND column_name = 'last_update'
-        """
-        cur, _ = run_query(
-            __context__["mysql_client"],
-            query,
-            args=(__context__["mysql_kwargs"]["db"], __context__["mysql_table_name"]),
-        )
-        r = cur.fetchone()
-        cur.close()
-        if r[0] == 1:
+    r = rows[0]
+    if r[0]:
+        if r[1]:
             return
         else:
             query = """
@@ -200,8 +544,7 @@ def _create_table():
             """.format(
                 __context__["mysql_kwargs"]["db"], __context__["mysql_table_name"]
             )
-            cur, _ = run_query(__context__["mysql_client"], query)
-            cur.close()
+            run_query(None, query)
             return
 
     query = """CREATE TABLE IF NOT EXISTS {} (
@@ -216,48 +559,182 @@ def _create_table():
         __context__["mysql_table_name"]
     )
     log.info("mysql_cache: creating table %s", __context__["mysql_table_name"])
-    cur, _ = run_query(__context__.get("mysql_client"), query)
-    cur.close()
+    run_query(None, query)
+
+
+def _refuse_ext_type(code, data):
+    """
+    msgpack ``ext_hook`` making unpacking fail on extension types, which
+    only salt.payload knows how to decode.
+    """
+    raise ValueError(f"Unsupported msgpack extension type {code}")
+
+
+def _payload():
+    """
+    Return salt.payload, imported on first use as it is only needed for data
+    plain msgpack cannot handle.
+    """
+    import salt.payload  # pylint: disable=import-outside-toplevel
+
+    return salt.payload
+
+
+def _dumps(data):
+    """
+    Serialize ``data`` for storage, compressing it if configured to.
+    """
+    packed = None
+    if __context__.get("mysql_raw_msgpack", True):
+        try:
+            # Without bin types, like salt.payload, so valid UTF-8 bytes are
+            # read back as str like with every other cache backend
+            packed = salt.utils.msgpack.packb(data, use_bin_type=False)
+        except (TypeError, ValueError, OverflowError):
+            # Sets, datetimes, very long integers...
+            pass
+    if packed is None:
+        packed = _payload().dumps(data)
+    if __context__.get("mysql_compression") == "zstd":
+        packed = _ZSTD_MAGIC + zstandard.ZstdCompressor(level=_ZSTD_LEVEL).compress(packed)
+    return packed
+
+
+def _loads(data):
+    """
+    Deserialize ``data`` read from the database.
+    """
+    # Compressed or not depends on the configuration at the time of storing
+    if data.startswith(_ZSTD_MAGIC):
+        if not HAS_ZSTD:
+            raise SaltCacheError(
+                "Cannot read zstd compressed cache data, zstandard is not installed"
+            )
+        data = zstandard.ZstdDecompressor().decompress(data[len(_ZSTD_MAGIC) :])
+    if __context__.get("mysql_raw_msgpack", True):
+        try:
+            # Unpacking allocates many objects, don't let the GC walk them all
+            with _gc_pause:
+                return salt.utils.msgpack.unpackb(
+                    data, raw=False, use_list=True, ext_hook=_refuse_ext_type
+                )
+        except (UnicodeDecodeError, ValueError):
+            # Written by salt.payload, e.g. with extension types or with
+            # binary data not marked as such
+            pass
+    return _payload().loads(data)
+
+
+def _build_queries(table_name):
+    """
+    Return the queries used by the cache functions for the given table, so
+    they only need to be formatted once.
+    """
+    # These are not server-side prepared statements: neither mysqlclient nor
+    # PyMySQL support the binary protocol, and ``EXECUTE ... USING`` only
+    # accepts user variables, which would cost an extra ``SET`` round trip.
+    return {
+        # Update in place rather than REPLACE INTO's DELETE + INSERT. The
+        # timestamp is bumped explicitly, as ON UPDATE CURRENT_TIMESTAMP only
+        # fires when the data actually changed.
+        "store": (
+            f"INSERT INTO {table_name} (bank, etcd_key, data) VALUES (%s,%s,%s) "
+            "ON DUPLICATE KEY UPDATE data=VALUES(data), last_update=CURRENT_TIMESTAMP"
+        ),
+        "fetch": (
+            f"SELECT data FROM {table_name} USE INDEX (PRIMARY) "
+            "WHERE bank=%s AND etcd_key=%s LIMIT 1"
+        ),
+        "flush_bank": f"DELETE FROM {table_name} WHERE bank=%s LIMIT %s",
+        "flush_key": f"DELETE FROM {table_name} WHERE bank=%s AND etcd_key=%s",
+        "ls": f"SELECT etcd_key FROM {table_name} WHERE bank=%s",
+        "contains_bank": f"SELECT 1 FROM {table_name} WHERE bank=%s LIMIT 1",
+        "contains_key": f"SELECT 1 FROM {table_name} WHERE bank=%s AND etcd_key=%s LIMIT 1",
+        "updated": (
+            f"SELECT UNIX_TIMESTAMP(last_update) FROM {table_name} "
+            "WHERE bank=%s AND etcd_key=%s LIMIT 1"
+        ),
+    }
+
+
+def _positive_int(opts, name, default):
+    """
+    Pop the option ``name`` from ``opts`` as a positive integer, falling back
+    to ``default`` if it is unset or not positive.
+    """
+    value = int(opts.pop(name, None) or default)
+    if value < 1:
+        log.warning("mysql_cache: mysql.%s must be positive, using %s", name, default)
+        return default
+    return value
 
 
 def _init_client():
     """Initialize connection and create table if needed"""
-    if __context__.get("mysql_client") is not None:
+    if __context__.get("mysql_ready"):
         return
 
-    opts = copy.deepcopy(__opts__)
+    # Only the mysql.* options are of interest, avoid copying all of __opts__
+    opts = {k.split(".")[1]: v for k, v in __opts__.items() if k.startswith("mysql.")}
     mysql_kwargs = {
         "autocommit": True,
-        "host": opts.pop("mysql.host", "127.0.0.1"),
-        "user": opts.pop("mysql.user", None),
-        "passwd": opts.pop("mysql.password", None),
-        "db": opts.pop("mysql.database", _DEFAULT_DATABASE_NAME),
-        "port": opts.pop("mysql.port", 3306),
-        "unix_socket": opts.pop("mysql.unix_socket", None),
-        "connect_timeout": opts.pop("mysql.connect_timeout", None),
+        "host": opts.pop("host", "127.0.0.1"),
+        "user": opts.pop("user", None),
+        "passwd": opts.pop("password", None),
+        "db": opts.pop("database", _DEFAULT_DATABASE_NAME),
+        "port": opts.pop("port", 3306),
+        "unix_socket": opts.pop("unix_socket", None),
+        "connect_timeout": opts.pop("connect_timeout", None),
     }
-    mysql_kwargs["autocommit"] = True
 
-    __context__["mysql_table_name"] = opts.pop("mysql.table_name", "salt")
-    __context__["mysql_fresh_connection"] = opts.pop("mysql.fresh_connection", False)
+    if opts.pop("driver", "mysqlclient") != "pymysql" and MySQLdb.__name__ == "pymysql":
+        log.warning(
+            "mysql_cache: mysqlclient is not installed, falling back to the slower "
+            "pure Python PyMySQL driver"
+        )
+
+    __context__["mysql_table_name"] = opts.pop("table_name", "salt")
+    __context__["mysql_queries"] = _build_queries(__context__["mysql_table_name"])
+    __context__["mysql_fresh_connection"] = opts.pop("fresh_connection", False)
+    __context__["mysql_pool_size"] = _positive_int(opts, "pool_size", _DEFAULT_POOL_SIZE)
+    __context__["mysql_ping_on_checkout"] = opts.pop("ping_on_checkout", False)
+    __context__["mysql_raw_msgpack"] = opts.pop("raw_msgpack", True)
+    __context__["mysql_async_store"] = opts.pop("async_store", False)
+    __context__["mysql_batch_size"] = int(opts.pop("batch_size", _DEFAULT_BATCH_SIZE))
+    __context__["mysql_batch_ms"] = float(opts.pop("batch_ms", _DEFAULT_BATCH_MS))
+    read_cache_size = int(opts.pop("read_cache_size", _DEFAULT_READ_CACHE_SIZE))
+    read_cache_ttl = float(opts.pop("read_cache_ttl", 0))
+    if read_cache_size > 0 and read_cache_ttl > 0:
+        __context__["mysql_read_cache"] = _ReadCache(read_cache_size, read_cache_ttl)
+    else:
+        __context__.pop("mysql_read_cache", None)
+    __context__["mysql_flush_chunk"] = _positive_int(opts, "flush_chunk", _DEFAULT_FLUSH_CHUNK)
+    gc_freeze = opts.pop("gc_freeze", False)
+    compression = opts.pop("compression", None)
+    if compression not in (None, "zstd"):
+        raise SaltCacheError(f"Unsupported mysql.compression: {compression}")
+    if compression == "zstd" and not HAS_ZSTD:
+        raise SaltCacheError("mysql.compression is set to zstd, but zstandard is not installed")
+    __context__["mysql_compression"] = compression
 
     # Gather up any additional MySQL configuration options
-    for k in opts:
-        if k.startswith("mysql."):
-            _key = k.split(".")[1]
-            mysql_kwargs[_key] = opts.get(k)
+    mysql_kwargs.update(opts)
 
     # TODO: handle SSL connection parameters
 
-    for k, v in copy.deepcopy(mysql_kwargs).items():
-        if v is None:
-            mysql_kwargs.pop(k)
+    mysql_kwargs = {k: v for k, v in mysql_kwargs.items() if v is not None}
     kwargs_copy = mysql_kwargs.copy()
     kwargs_copy["passwd"] = "<hidden>"
     log.info("mysql_cache: Setting up client with params: %r", kwargs_copy)
     __context__["mysql_kwargs"] = mysql_kwargs
-    # The MySQL client is created later on by run_query
+    # The connection pool is created later on by run_query
     _create_table()
+    # Only skip the setup once the table is known to exist
+    __context__["mysql_ready"] = True
+
+    if gc_freeze:
+        gc.collect()
+        gc.freeze()
 
 
 def store(bank, key, data):
@@ -265,32 +742,47 @@ def store(bank, key, data):
     Store a key value.
     """
     _init_client()
-    data = salt.payload.dumps(data)
-    query = "REPLACE INTO {} (bank, etcd_key, data) values(%s,%s,%s)".format(
-        __context__["mysql_table_name"]
-    )
+    data = _dumps(data)
+    query = __context__["mysql_queries"]["store"]
     args = (bank, key, data)
+    read_cache = __context__.get("mysql_read_cache")
+
+    if __context__.get("mysql_async_store"):
+        _get_write_queue().put(args)
+        # The write might still fail, let the next read go to the database
+        if read_cache is not None:
+            read_cache.invalidate(bank, key)
+        return
 
-    cur, cnt = run_query(__context__.get("mysql_client"), query, args=args)
-    cur.close()
-    if cnt not in (1, 2):
+    _, cnt = run_query(None, query, args=args)
+    # 1 for an insert, 2 for an update, 0 if the row did not change
+    if cnt not in (0, 1, 2):
         raise SaltCacheError(f"Error storing {bank} {key} returned {cnt}")
 
+    if read_cache is not None:
+        read_cache.invalidate(bank, key)
+        read_cache.set(("fetch", bank, key), data)
+
 
 def fetch(bank, key):
     """
     Fetch a key value.
     """
     _init_client()
-    query = "SELECT data FROM {} WHERE bank=%s AND etcd_key=%s".format(
-        __context__["mysql_table_name"]
-    )
-    cur, _ = run_query(__context__.get("mysql_client"), query, args=(bank, key))
-    r = cur.fetchone()
-    cur.close()
-    if r is None:
+    read_cache = __context__.get("mysql_read_cache")
+    if read_cache is not None:
+        data = read_cache.get(("fetch", bank, key))
+        if data is not None:
+            return _loads(data)
+
+    _wait_for_writes()
+    query = __context__["mysql_queries"]["fetch"]
+    rows, _ = run_query(None, query, args=(bank, key))
+    if not rows:
         return {}
-    return salt.payload.loads(r[0])
+    if read_cache is not None:
+        read_cache.set(("fetch", bank, key), rows[0][0])
+    return _loads(rows[0][0])
 
 
 def flush(bank, key=None):
@@ -298,15 +790,21 @@ def flush(bank, key=None):
     Remove the key from the cache bank with all the key content.
     """
     _init_client()
-    query = "DELETE FROM {} WHERE bank=%s".format(__context__["mysql_table_name"])
+    _wait_for_writes()
     if key is None:
-        data = (bank,)
+        # Delete large banks in chunks, to keep the row locks short-lived
+        chunk = __context__.get("mysql_flush_chunk", _DEFAULT_FLUSH_CHUNK)
+        query = __context__["mysql_queries"]["flush_bank"]
+        while True:
+            _, cnt = run_query(None, query, args=(bank, chunk))
+            if cnt < chunk:
+                break
     else:
-        data = (bank, key)
-        query += " AND etcd_key=%s"
-
-    cur, _ = run_query(__context__.get("mysql_client"), query, args=data)
-    cur.close()
+        query = __context__["mysql_queries"]["flush_key"]
+        run_query(None, query, args=(bank, key))
+    read_cache = __context__.get("mysql_read_cache")
+    if read_cache is not None:
+        read_cache.invalidate(bank, key)
 
 
 def ls(bank):
@@ -315,11 +813,23 @@ def ls(bank):
     bank.
     """
     _init_client()
-    query = "SELECT etcd_key FROM {} WHERE bank=%s".format(__context__["mysql_table_name"])
-    cur, _ = run_query(__context__.get("mysql_client"), query, args=(bank,))
-    out = [row[0] for row in cur.fetchall()]
-    cur.close()
-    return out
+    _wait_for_writes()
+    query = __context__["mysql_queries"]["ls"]
+    try:
+        # Read the keys straight off the wire instead of having the client
+        # library buffer the whole result set first
+        with _get_pool().connection() as conn:
+            rows, _ = run_query(
+                conn, query, args=(bank,), retries=0, cursor_class=MySQLdb.cursors.SSCursor
+            )
+    except (SaltCacheError, AttributeError, OperationalError, InterfaceError) as e:
+        # Only retry if the connection went away, on a new one through
+        # run_query. Any other error would just happen again.
+        cause = e.__cause__ if isinstance(e, SaltCacheError) else e
+        if not isinstance(cause, (AttributeError, OperationalError, InterfaceError)):
+            raise
+        rows, _ = run_query(None, query, args=(bank,))
+    return [row[0] for row in rows]
 
 
 def contains(bank, key):
@@ -327,18 +837,21 @@ def contains(bank, key):
     Checks if the specified bank contains the specified key.
     """
     _init_client()
+    read_cache = __context__.get("mysql_read_cache")
     if key is None:
         data = (bank,)
-        query = "SELECT COUNT(data) FROM {} WHERE bank=%s".format(__context__["mysql_table_name"])
+        query = __context__["mysql_queries"]["contains_bank"]
+    elif read_cache is not None and (
+        read_cache.get(("fetch", bank, key)) is not None
+        or read_cache.get(("updated", bank, key)) is not None
+    ):
+        return True
     else:
         data = (bank, key)
-        query = "SELECT COUNT(data) FROM {} WHERE bank=%s AND etcd_key=%s".format(
-            __context__["mysql_table_name"]
-        )
-    cur, _ = run_query(__context__.get("mysql_client"), query, args=data)
-    r = cur.fetchone()
-    cur.close()
-    return r[0] == 1
+        query = __context__["mysql_queries"]["contains_key"]
+    _wait_for_writes()
+    rows, _ = run_query(None, query, args=data)
+    return bool(rows)
 
 
 def updated(bank, key):
@@ -347,11 +860,18 @@ def updated(bank, key):
     key.
     """
     _init_client()
-    query = "SELECT UNIX_TIMESTAMP(last_update) FROM {} WHERE bank=%s " "AND etcd_key=%s".format(
-        __context__["mysql_table_name"]
-    )
+    read_cache = __context__.get("mysql_read_cache")
+    if read_cache is not None:
+        timestamp = read_cache.get(("updated", bank, key))
+        if timestamp is not None:
+            return timestamp
+
+    _wait_for_writes()
+    query = __context__["mysql_queries"]["updated"]
     data = (bank, key)
-    cur, _ = run_query(__context__.get("mysql_client"), query=query, args=data)
-    r = cur.fetchone()
-    cur.close()
-    return int(r[0]) if r else r
+    rows, _ = run_query(None, query=query, args=data)
+    if not rows:
+        return None
+    if read_cache is not None:
+        read_cache.set(("updated", bank, key), int(rows[0][0]))
+    return int(rows[0][0])
@@ -2,12 +2,17 @@
 unit tests for the mysql_cache cache
 """
 
+import datetime
+import gc
 import logging
+import threading
+import time
 from unittest.mock import MagicMock
 from unittest.mock import call
 from unittest.mock import patch
 
 import pytest
+import salt.payload
 from salt.exceptions import SaltCacheError
 
 from saltext.mysql.cache import mysql_cache
@@ -35,27 +40,132 @@ def test_run_query():
         mock_connect.assert_has_calls((expected_calls,), True)
 
 
+def test_run_query_redacts_data(caplog):
+    """
+    Tests that serialized data does not end up in the logs or in error
+    messages.
+    """
+    mock_connect = MagicMock()
+    args = ("bank", "key", b"\xa4data" * 1000)
+    with caplog.at_level(logging.DEBUG, logger=mysql_cache.__name__):
+        mysql_cache.run_query(conn=mock_connect, query="SELECT 1;", args=args)
+    assert "('bank', 'key', '<5000 bytes>')" in caplog.text
+    assert "data" not in caplog.text
+
+    mock_connect.cursor.return_value.execute.side_effect = ValueError("boom")
+    with pytest.raises(SaltCacheError) as exc_info:
+        mysql_cache.run_query(conn=mock_connect, query="SELECT 1;", args=args)
+    assert "<5000 bytes>" in str(exc_info.value)
+    assert "data" not in str(exc_info.value)
+
+
+def test_run_query_retry():
+    """
+    Tests that run_query retries on a new connection with a growing delay,
+    and raises a SaltCacheError once it runs out of retries.
+    """
+    with patch("MySQLdb.connect", MagicMock()) as mock_connect:
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.return_value = ((1,),)
+        cursor.execute.side_effect = [
+            mysql_cache.OperationalError("gone away"),
+            mysql_cache.OperationalError("gone away"),
+            1,
+        ]
+        with patch.dict(mysql_cache.__context__, {"mysql_kwargs": {}}):
+            with patch("time.sleep") as mock_sleep:
+                assert mysql_cache.run_query(None, "SELECT 1;") == (((1,),), 1)
+                assert mock_connect.call_count == 3
+                first, second = (args[0][0] for args in mock_sleep.call_args_list)
+                assert 0.025 <= first <= 0.075
+                assert 0.05 <= second <= 0.15
+
+                cursor.execute.side_effect = mysql_cache.OperationalError("gone away")
+                with pytest.raises(SaltCacheError, match="gone away") as exc_info:
+                    mysql_cache.run_query(None, "SELECT 1;", retries=2)
+                assert isinstance(exc_info.value.__cause__, mysql_cache.OperationalError)
+
+
+def test_run_query_pool():
+    """
+    Tests that run_query reuses pooled connections unless a fresh connection
+    is requested.
+    """
+    with patch("MySQLdb.connect", MagicMock()) as mock_connect:
+        with patch.dict(mysql_cache.__context__, {"mysql_kwargs": {"db": "salt_cache"}}):
+            mysql_cache.run_query(None, "SELECT 1;")
+            mysql_cache.run_query(None, "SELECT 1;")
+            mock_connect.assert_called_once_with(db="salt_cache")
+            mock_connect.return_value.close.assert_not_called()
+
+            mysql_cache.force_reconnect()
+            mock_connect.return_value.close.assert_called_once()
+
+    with patch("MySQLdb.connect", MagicMock()) as mock_connect:
+        with patch.dict(
+            mysql_cache.__context__,
+            {"mysql_kwargs": {"db": "salt_cache"}, "mysql_fresh_connection": True},
+        ):
+            mysql_cache.run_query(None, "SELECT 1;")
+            mysql_cache.run_query(None, "SELECT 1;")
+            assert mock_connect.call_count == 2
+            assert mock_connect.return_value.close.call_count == 2
+
+
+def test_run_query_closes_cursor():
+    """
+    Tests that run_query reads the result and closes the cursor before the
+    connection is handed back
+    """
+    with patch("MySQLdb.connect", MagicMock()) as mock_connect:
+        events = []
+        cursor = mock_connect.return_value.cursor.return_value
+        cursor.fetchall.side_effect = lambda: events.append("fetchall") or ((1,),)
+        cursor.close.side_effect = lambda: events.append("cursor.close")
+        mock_connect.return_value.close.side_effect = lambda: events.append("conn.close")
+        with patch.dict(
+            mysql_cache.__context__,
+            {"mysql_kwargs": {}, "mysql_fresh_connection": True},
+        ):
+            cursor.execute.return_value = 1
+            assert mysql_cache.run_query(None, "SELECT 1;") == (((1,),), 1)
+            assert events == ["fetchall", "cursor.close", "conn.close"]
+
+            # Queries without a result set are not fetched from
+            events.clear()
+            cursor.description = None
+            assert mysql_cache.run_query(None, "DELETE FROM salt;")[0] == ()
+            assert events == ["cursor.close", "conn.close"]
+
+            # The cursor is closed on errors too
+            events.clear()
+            cursor.execute.side_effect = ValueError("boom")
+            with pytest.raises(SaltCacheError):
+                mysql_cache.run_query(None, "SELECT 1;")
+            assert events == ["cursor.close", "conn.close"]
+
+
 def test_store():
     """
     Tests that the store function writes the data to the serializer for storage.
     """
 
-    mock_connect_client = MagicMock()
     with patch.object(mysql_cache, "_init_client"):
         with patch.dict(
             mysql_cache.__context__,
             {
                 "mysql_table_name": "salt",
-                "mysql_client": mock_connect_client,
+                "mysql_queries": mysql_cache._build_queries("salt"),
             },
         ):
             with patch.object(mysql_cache, "run_query") as mock_run_query:
-                mock_run_query.return_value = (MagicMock(), 1)
+                mock_run_query.return_value = ((), 1)
 
                 expected_calls = [
                     call(
-                        mock_connect_client,
-                        "REPLACE INTO salt (bank, etcd_key, data) values(%s,%s,%s)",
+                        None,
+                        "INSERT INTO salt (bank, etcd_key, data) VALUES (%s,%s,%s) "
+                        "ON DUPLICATE KEY UPDATE data=VALUES(data), last_update=CURRENT_TIMESTAMP",
                         args=("minions/minion", "key1", b"\xa4data"),
                     )
                 ]
@@ -67,12 +177,13 @@ def test_store():
                 mock_run_query.assert_has_calls(expected_calls, True)
 
             with patch.object(mysql_cache, "run_query") as mock_run_query:
-                mock_run_query.return_value = (MagicMock(), 2)
+                mock_run_query.return_value = ((), 2)
 
                 expected_calls = [
                     call(
-                        mock_connect_client,
-                        "REPLACE INTO salt (bank, etcd_key, data) values(%s,%s,%s)",
+                        None,
+                        "INSERT INTO salt (bank, etcd_key, data) VALUES (%s,%s,%s) "
+                        "ON DUPLICATE KEY UPDATE data=VALUES(data), last_update=CURRENT_TIMESTAMP",
                         args=("minions/minion", "key2", b"\xa4data"),
                     )
                 ]
@@ -84,13 +195,135 @@ def test_store():
                 mock_run_query.assert_has_calls(expected_calls, True)
 
             with patch.object(mysql_cache, "run_query") as mock_run_query:
-                mock_run_query.return_value = (MagicMock(), 0)
+                # Storing an unchanged value does not affect any row
+                mock_run_query.return_value = ((), 0)
+                try:
+                    mysql_cache.store(bank="minions/minion", key="key2", data="data")
+                except SaltCacheError:
+                    pytest.fail("This test should not raise an exception")
+
+            with patch.object(mysql_cache, "run_query") as mock_run_query:
+                mock_run_query.return_value = ((), 3)
                 with pytest.raises(SaltCacheError) as exc_info:
                     mysql_cache.store(bank="minions/minion", key="data", data="data")
-                expected = "Error storing minions/minion data returned 0"
+                expected = "Error storing minions/minion data returned 3"
                 assert expected in str(exc_info.value)
 
 
+def test_store_async():
+    """
+    Tests that the store function queues the data for the background writer
+    when mysql.async_store is enabled.
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch("MySQLdb.connect") as mock_connect:
+            cursor = mock_connect.return_value.cursor.return_value
+            with patch.dict(
+                mysql_cache.__context__,
+                {
+                    "mysql_kwargs": {},
+                    "mysql_table_name": "salt",
+                    "mysql_queries": mysql_cache._build_queries("salt"),
+                    "mysql_async_store": True,
+                },
+            ):
+                mysql_cache.store(bank="minions/minion", key="key1", data="data")
+                mysql_cache.store(bank="minions/minion", key="key2", data="data")
+                mysql_cache._get_write_queue().join()
+
+                rows = [row for args in cursor.executemany.call_args_list for row in args[0][1]]
+                assert rows == [
+                    ("minions/minion", "key1", b"\xa4data"),
+                    ("minions/minion", "key2", b"\xa4data"),
+                ]
+                for args in cursor.executemany.call_args_list:
+                    assert args[0][0] == mysql_cache.__context__["mysql_queries"]["store"]
+                cursor.execute.assert_not_called()
+
+
+def test_store_async_read_cache():
+    """
+    Tests that queued values are not served from the read cache, as they
+    might never make it to the database
+    """
+    read_cache = mysql_cache._ReadCache(maxsize=4, ttl=60)
+    read_cache.set(("fetch", "minions/minion", "key"), b"\xa3old")
+    with patch.object(mysql_cache, "_init_client"):
+        with patch("MySQLdb.connect") as mock_connect:
+            cursor = mock_connect.return_value.cursor.return_value
+            cursor.executemany.side_effect = mysql_cache.OperationalError("gone away")
+            cursor.fetchall.return_value = ()
+            with patch.dict(
+                mysql_cache.__context__,
+                {
+                    "mysql_kwargs": {},
+                    "mysql_table_name": "salt",
+                    "mysql_queries": mysql_cache._build_queries("salt"),
+                    "mysql_async_store": True,
+                    "mysql_read_cache": read_cache,
+                },
+            ):
+                with patch("time.sleep"):
+                    mysql_cache.store(bank="minions/minion", key="key", data="data")
+                    assert read_cache.get(("fetch", "minions/minion", "key")) is None
+                    assert mysql_cache.fetch(bank="minions/minion", key="key") == {}
+
+
+def test_get_write_queue_once():
+    """
+    Tests that concurrent first writes share a single queue and writer thread
+    """
+    barrier = threading.Barrier(8)
+    queues = []
+
+    def first_write():
+        barrier.wait()
+        queues.append(mysql_cache._get_write_queue())
+
+    threads = [threading.Thread(target=first_write) for _ in range(8)]
+    with patch.dict(
+        mysql_cache.__context__,
+        {"mysql_queries": mysql_cache._build_queries("salt"), "mysql_pool": MagicMock()},
+    ):
+        with patch("threading.Thread") as mock_thread:
+            # Widen the window between checking for and registering the queue
+            mock_thread.return_value.start.side_effect = lambda: time.sleep(0.01)
+            with patch("atexit.register"):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+    assert len({id(write_queue) for write_queue in queues}) == 1
+    mock_thread.return_value.start.assert_called_once()
+
+
+def test_store_async_flush():
+    """
+    Tests that a flush waits for the queued writes, so it is not undone by
+    them
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch("MySQLdb.connect") as mock_connect:
+            cursor = mock_connect.return_value.cursor.return_value
+            cursor.execute.return_value = 1
+            calls = []
+            cursor.executemany.side_effect = lambda query, rows: calls.append("store")
+            cursor.execute.side_effect = lambda query, args: calls.append("flush")
+            with patch.dict(
+                mysql_cache.__context__,
+                {
+                    "mysql_kwargs": {},
+                    "mysql_table_name": "salt",
+                    "mysql_queries": mysql_cache._build_queries("salt"),
+                    "mysql_async_store": True,
+                    "mysql_batch_ms": 100,
+                },
+            ):
+                mysql_cache.store(bank="minions/minion", key="key", data="data")
+                mysql_cache.flush(bank="minions/minion", key="key")
+                assert calls == ["store", "flush"]
+
+
 def test_fetch():
     """
     Tests that the fetch function reads the data from the serializer for storage.
@@ -100,45 +333,190 @@ def test_fetch():
         with patch("MySQLdb.connect") as mock_connect:
             mock_connection = mock_connect.return_value
             cursor = mock_connection.cursor.return_value
-            cursor.fetchone.return_value = (b"\xa5hello",)
+            cursor.fetchall.return_value = ((b"\xa5hello",),)
 
             with patch.dict(
                 mysql_cache.__context__,
                 {
-                    "mysql_client": mock_connection,
+                    "mysql_kwargs": {},
                     "mysql_table_name": "salt",
+                    "mysql_queries": mysql_cache._build_queries("salt"),
                 },
             ):
                 ret = mysql_cache.fetch(bank="bank", key="key")
                 assert ret == "hello"
 
 
+def test_serialization():
+    """
+    Tests that data msgpack cannot handle on its own goes through salt.payload,
+    in both directions
+    """
+    data = {"some": ["data", b"\x00\xff"], 42: {"sub": 1}}
+    assert mysql_cache._loads(mysql_cache._dumps(data)) == data
+
+    # Like salt.payload, bytes are read back as str if they are valid UTF-8
+    assert mysql_cache._loads(mysql_cache._dumps({"k": b"abc"})) == {"k": "abc"}
+    data = {"k": b"abc", b"key": ["data", b"\x00\xff"]}
+    packed = mysql_cache._dumps(data)
+    assert packed == salt.payload.dumps(data)
+    assert mysql_cache._loads(packed) == {"k": "abc", "key": ["data", b"\x00\xff"]}
+    assert mysql_cache._loads(packed) == salt.payload.loads(packed)
+
+    data = {"when": datetime.datetime(2024, 8, 8, 12, 0), "what": {"a", "b"}}
+    packed = mysql_cache._dumps(data)
+    assert packed == salt.payload.dumps(data)
+    assert mysql_cache._loads(packed) == {
+        "when": data["when"],
+        "what": list(data["what"]),
+    }
+
+    with patch.dict(mysql_cache.__context__, {"mysql_raw_msgpack": False}):
+        with patch.object(salt.payload, "dumps") as mock_dumps:
+            mysql_cache._dumps("data")
+            mock_dumps.assert_called_once_with("data")
+
+
+def test_loads_gc():
+    """
+    Tests that unpacking leaves the garbage collector as it found it, and
+    that it is only enabled again once no thread is unpacking anymore
+    """
+    packed = mysql_cache._dumps({"some": "data"})
+    assert gc.isenabled()
+    mysql_cache._loads(packed)
+    assert gc.isenabled()
+
+    gc.disable()
+    try:
+        mysql_cache._loads(packed)
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+
+    with mysql_cache._gc_pause:
+        mysql_cache._loads(packed)
+        assert not gc.isenabled()
+    assert gc.isenabled()
+
+
+def test_read_cache():
+    """
+    Tests that fetched values are served from the read cache until they are
+    stored again or flushed.
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch.dict(
+            mysql_cache.__context__,
+            {
+                "mysql_table_name": "salt",
+                "mysql_queries": mysql_cache._build_queries("salt"),
+                "mysql_read_cache": mysql_cache._ReadCache(maxsize=2, ttl=60),
+            },
+        ):
+            with patch.object(mysql_cache, "run_query") as mock_run_query:
+                mock_run_query.return_value = (((b"\xa5hello",),), 1)
+
+                assert mysql_cache.fetch(bank="bank", key="key") == "hello"
+                assert mysql_cache.fetch(bank="bank", key="key") == "hello"
+                assert mysql_cache.contains(bank="bank", key="key")
+                assert mock_run_query.call_count == 1
+
+                mysql_cache.store(bank="bank", key="key", data="world")
+                assert mysql_cache.fetch(bank="bank", key="key") == "world"
+                assert mock_run_query.call_count == 2
+
+                mysql_cache.flush(bank="bank")
+                assert mysql_cache.fetch(bank="bank", key="key") == "hello"
+                assert mock_run_query.call_count == 4
+
+                # Least recently used entries are evicted
+                mysql_cache.fetch(bank="bank", key="key2")
+                mysql_cache.fetch(bank="bank", key="key3")
+                mysql_cache.fetch(bank="bank", key="key")
+                assert mock_run_query.call_count == 7
+
+    read_cache = mysql_cache._ReadCache(maxsize=4, ttl=60)
+    for entry in (
+        ("fetch", "bank", "key"),
+        ("updated", "bank", "key"),
+        ("fetch", "bank", "key2"),
+        ("fetch", "other", "key"),
+    ):
+        read_cache.set(entry, b"\xa5hello")
+    read_cache.invalidate("bank", "key")
+    assert read_cache.get(("fetch", "bank", "key")) is None
+    assert read_cache.get(("updated", "bank", "key")) is None
+    assert read_cache.get(("fetch", "bank", "key2")) is not None
+    read_cache.invalidate("bank")
+    assert read_cache.get(("fetch", "bank", "key2")) is None
+    assert read_cache.get(("fetch", "other", "key")) is not None
+
+    read_cache = mysql_cache._ReadCache(maxsize=2, ttl=60)
+    with patch("time.monotonic", return_value=0):
+        read_cache.set(("fetch", "bank", "key"), b"\xa5hello")
+    with patch("time.monotonic", return_value=61):
+        assert read_cache.get(("fetch", "bank", "key")) is None
+
+
+def test_compression():
+    """
+    Tests that values are compressed if configured to, and that compressed
+    and uncompressed values can be read either way.
+    """
+    plain = mysql_cache._dumps({"some": "data" * 100})
+    assert mysql_cache._loads(plain) == {"some": "data" * 100}
+
+    with patch.object(mysql_cache, "HAS_ZSTD", False):
+        with pytest.raises(SaltCacheError, match="zstandard is not installed"):
+            mysql_cache._loads(b"zstd1\x28\xb5\x2f\xfd")
+
+    pytest.importorskip("zstandard")
+    with patch.dict(mysql_cache.__context__, {"mysql_compression": "zstd"}):
+        compressed = mysql_cache._dumps({"some": "data" * 100})
+        assert compressed.startswith(b"zstd1")
+        assert len(compressed) < len(plain)
+        assert mysql_cache._loads(compressed) == {"some": "data" * 100}
+        assert mysql_cache._loads(plain) == {"some": "data" * 100}
+    assert mysql_cache._loads(compressed) == {"some": "data" * 100}
+
+
 def test_flush():
     """
     Tests the flush function in mysql_cache.
     """
-    mock_connect_client = MagicMock()
     with patch.object(mysql_cache, "_init_client"):
         with patch.dict(
             mysql_cache.__context__,
-            {"mysql_client": mock_connect_client, "mysql_table_name": "salt"},
+            {"mysql_table_name": "salt", "mysql_queries": mysql_cache._build_queries("salt")},
         ):
             with patch.object(mysql_cache, "run_query") as mock_run_query:
 
                 expected_calls = [
                     call(
-                        mock_connect_client,
-                        "DELETE FROM salt WHERE bank=%s",
-                        args=("bank",),
+                        None,
+                        "DELETE FROM salt WHERE bank=%s LIMIT %s",
+                        args=("bank", 10000),
                     ),
                 ]
-                mock_run_query.return_value = (MagicMock(), "")
+                mock_run_query.return_value = ((), 0)
                 mysql_cache.flush(bank="bank")
                 mock_run_query.assert_has_calls(expected_calls, True)
 
+                # Large banks are deleted in chunks until a chunk comes up short
+                mock_run_query.reset_mock()
+                mock_run_query.side_effect = [
+                    ((), 10000),
+                    ((), 10000),
+                    ((), 3),
+                ]
+                mysql_cache.flush(bank="bank")
+                assert mock_run_query.call_count == 3
+                mock_run_query.side_effect = None
+
                 expected_calls = [
                     call(
-                        mock_connect_client,
+                        None,
                         "DELETE FROM salt WHERE bank=%s AND etcd_key=%s",
                         args=("bank", "key"),
                     )
@@ -147,6 +525,111 @@ def test_flush():
                 mock_run_query.assert_has_calls(expected_calls, True)
 
 
+def test_ls():
+    """
+    Tests that the ls function reads the keys of the given bank with an
+    unbuffered cursor and returns them as they are stored.
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch("MySQLdb.connect") as mock_connect:
+            mock_connection = mock_connect.return_value
+            cursor = mock_connection.cursor.return_value
+            cursor.fetchall.return_value = (("key1",), ("minions/key2",))
+
+            with patch.dict(
+                mysql_cache.__context__,
+                {
+                    "mysql_kwargs": {},
+                    "mysql_table_name": "salt",
+                    "mysql_queries": mysql_cache._build_queries("salt"),
+                },
+            ):
+                assert mysql_cache.ls(bank="minions") == ["key1", "minions/key2"]
+                mock_connection.cursor.assert_called_once_with(mysql_cache.MySQLdb.cursors.SSCursor)
+                cursor.execute.assert_called_once_with(
+                    "SELECT etcd_key FROM salt WHERE bank=%s", ("minions",)
+                )
+                cursor.close.assert_called_once()
+
+
+def test_ls_fallback():
+    """
+    Tests that ls retries on a new buffered connection if the connection
+    went away, but not on other errors
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch("MySQLdb.connect") as mock_connect:
+            cursor = mock_connect.return_value.cursor.return_value
+            cursor.fetchall.return_value = (("key1",),)
+            with patch.dict(
+                mysql_cache.__context__,
+                {
+                    "mysql_kwargs": {},
+                    "mysql_table_name": "salt",
+                    "mysql_queries": mysql_cache._build_queries("salt"),
+                },
+            ):
+                cursor.execute.side_effect = [mysql_cache.OperationalError("gone away"), 1]
+                assert mysql_cache.ls(bank="minions") == ["key1"]
+                assert cursor.execute.call_count == 2
+                mock_connect.return_value.cursor.assert_called_with()
+
+                cursor.execute.reset_mock()
+                cursor.execute.side_effect = ValueError("no such table")
+                with pytest.raises(SaltCacheError, match="no such table"):
+                    mysql_cache.ls(bank="minions")
+                cursor.execute.assert_called_once()
+
+
+def test_contains():
+    """
+    Tests that the contains function stops at the first matching row, and
+    reports banks with several keys as existing.
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch.dict(
+            mysql_cache.__context__,
+            {"mysql_table_name": "salt", "mysql_queries": mysql_cache._build_queries("salt")},
+        ):
+            with patch.object(mysql_cache, "run_query") as mock_run_query:
+                mock_run_query.return_value = (((1,),), 2)
+                assert mysql_cache.contains(bank="bank", key=None)
+                mock_run_query.assert_called_with(
+                    None, "SELECT 1 FROM salt WHERE bank=%s LIMIT 1", args=("bank",)
+                )
+
+                mock_run_query.return_value = ((), 0)
+                assert not mysql_cache.contains(bank="bank", key="key")
+                mock_run_query.assert_called_with(
+                    None,
+                    "SELECT 1 FROM salt WHERE bank=%s AND etcd_key=%s LIMIT 1",
+                    args=("bank", "key"),
+                )
+
+
+def test_updated():
+    """
+    Tests that the updated function only reads the timestamp of a single row.
+    """
+    with patch.object(mysql_cache, "_init_client"):
+        with patch.dict(
+            mysql_cache.__context__,
+            {"mysql_table_name": "salt", "mysql_queries": mysql_cache._build_queries("salt")},
+        ):
+            with patch.object(mysql_cache, "run_query") as mock_run_query:
+                mock_run_query.return_value = (((1723118400,),), 1)
+                assert mysql_cache.updated(bank="bank", key="key") == 1723118400
+                mock_run_query.assert_called_with(
+                    None,
+                    query="SELECT UNIX_TIMESTAMP(last_update) FROM salt "
+                    "WHERE bank=%s AND etcd_key=%s LIMIT 1",
+                    args=("bank", "key"),
+                )
+
+                mock_run_query.return_value = ((), 0)
+                assert mysql_cache.updated(bank="bank", key="key") is None
+
+
 def test_init_client():
     """
     Tests that the _init_client places the correct information in __context__
@@ -169,6 +652,7 @@ def test_init_client():
             assert mysql_cache.__context__["mysql_kwargs"]["max_allowed_packet"] == 100000
             assert not mysql_cache.__context__["mysql_fresh_connection"]
 
+    mysql_cache.force_reconnect()
     with patch.dict(
         mysql_cache.__opts__,
         {
@@ -193,22 +677,119 @@ def test_init_client():
             assert mysql_cache.__context__["mysql_fresh_connection"]
 
 
+def test_init_client_once():
+    """
+    Tests that _init_client only reads the configuration until the table has
+    been set up, and leaves __opts__ untouched
+    """
+    with patch.dict(mysql_cache.__opts__, {"mysql.table_name": "cache"}):
+        with patch.object(mysql_cache, "_create_table") as mock_create_table:
+            mysql_cache._init_client()
+            assert mysql_cache.__opts__["mysql.table_name"] == "cache"
+            assert mysql_cache.__context__["mysql_table_name"] == "cache"
+            assert mysql_cache.__context__["mysql_queries"]["fetch"] == (
+                "SELECT data FROM cache USE INDEX (PRIMARY) WHERE bank=%s AND etcd_key=%s LIMIT 1"
+            )
+            mock_create_table.assert_called_once()
+
+            mysql_cache._init_client()
+            mock_create_table.assert_called_once()
+
+            mysql_cache.force_reconnect()
+            mysql_cache._init_client()
+            assert mock_create_table.call_count == 2
+
+
+def test_init_client_retry():
+    """
+    Tests that the table is still created if the first attempt to set up the
+    client failed
+    """
+    with patch.object(mysql_cache, "_create_table") as mock_create_table:
+        mock_create_table.side_effect = [SaltCacheError("MySQL Error 2003"), None]
+        with pytest.raises(SaltCacheError):
+            mysql_cache._init_client()
+        # The pool might already exist, as run_query creates it
+        mysql_cache.__context__["mysql_pool"] = MagicMock()
+        mysql_cache._init_client()
+        assert mock_create_table.call_count == 2
+        assert mysql_cache.__context__["mysql_ready"]
+
+
+@pytest.mark.parametrize("pool_size,expected", [(5, 5), (None, 10), (0, 10), (-1, 10)])
+def test_init_client_pool_size(pool_size, expected):
+    """
+    Tests that a pool that could never hand out a connection is not set up
+    """
+    with patch.dict(mysql_cache.__opts__, {"mysql.pool_size": pool_size}):
+        with patch.object(mysql_cache, "_create_table"):
+            mysql_cache._init_client()
+            assert mysql_cache.__context__["mysql_pool_size"] == expected
+            assert "pool_size" not in mysql_cache.__context__["mysql_kwargs"]
+
+
+@pytest.mark.parametrize("flush_chunk,expected", [(500, 500), (0, 10000), (-1, 10000)])
+def test_init_client_flush_chunk(flush_chunk, expected):
+    """
+    Tests that flushing a bank always deletes at least one row per query, as
+    it would never finish otherwise
+    """
+    with patch.dict(mysql_cache.__opts__, {"mysql.flush_chunk": flush_chunk}):
+        with patch.object(mysql_cache, "_create_table"):
+            mysql_cache._init_client()
+            assert mysql_cache.__context__["mysql_flush_chunk"] == expected
+
+
+@pytest.mark.parametrize(
+    "module_name,driver,warns",
+    [
+        ("pymysql", None, True),
+        ("pymysql", "pymysql", False),
+        ("MySQLdb", None, False),
+    ],
+)
+def test_init_client_driver(caplog, module_name, driver, warns):
+    """
+    Tests that falling back to PyMySQL logs a warning, unless it was asked for
+    """
+    opts = {"mysql.driver": driver} if driver else {}
+    with patch.dict(mysql_cache.__opts__, opts):
+        with patch.object(mysql_cache.MySQLdb, "__name__", module_name):
+            with patch.object(mysql_cache, "_create_table"):
+                with caplog.at_level(logging.WARNING):
+                    mysql_cache._init_client()
+    assert ("falling back to the slower pure Python PyMySQL driver" in caplog.text) is warns
+    assert "driver" not in mysql_cache.__context__["mysql_kwargs"]
+
+
+@pytest.mark.parametrize("gc_freeze", [True, False])
+def test_init_client_gc_freeze(gc_freeze):
+    """
+    Tests that the objects created during the client setup are only frozen
+    when asked to
+    """
+    with patch.dict(mysql_cache.__opts__, {"mysql.gc_freeze": gc_freeze}):
+        with patch.object(mysql_cache, "_create_table"):
+            with patch("gc.freeze") as mock_freeze:
+                mysql_cache._init_client()
+                assert mock_freeze.called is gc_freeze
+                assert "gc_freeze" not in mysql_cache.__context__["mysql_kwargs"]
+
+
 def test_create_table():
     """
     Tests that the _create_table
     """
 
-    mock_connect_client = MagicMock()
     with patch.dict(
         mysql_cache.__context__,
         {
             "mysql_table_name": "salt",
-            "mysql_client": mock_connect_client,
             "mysql_kwargs": {"db": "salt_cache"},
         },
     ):
         with patch.object(mysql_cache, "run_query") as mock_run_query:
-            mock_run_query.return_value = (MagicMock(), 1)
+            mock_run_query.return_value = (((0, 0),), 1)
 
             sql_call = """CREATE TABLE IF NOT EXISTS salt (
       bank CHAR(255),
@@ -219,9 +800,21 @@ def test_create_table():
                   ON UPDATE CURRENT_TIMESTAMP,
       PRIMARY KEY(bank, etcd_key)
     );"""
-            expected_calls = [call(mock_connect_client, sql_call)]
+            expected_calls = [call(None, sql_call)]
             try:
                 mysql_cache._create_table()
             except SaltCacheError:
                 pytest.fail("This test should not raise an exception")
             mock_run_query.assert_has_calls(expected_calls, True)
+
+            # The table and the last_update column are looked up in one query
+            mock_run_query.reset_mock()
+            mock_run_query.return_value = (((4, 1),), 1)
+            mysql_cache._create_table()
+            mock_run_query.assert_called_once()
+
+            mock_run_query.reset_mock()
+            mock_run_query.return_value = (((3, 0),), 1)
+            mysql_cache._create_table()
+            assert mock_run_query.call_count == 2
+            assert "ADD COLUMN last_update" in mock_run_query.call_args[0][1]
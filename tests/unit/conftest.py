@@ -4,14 +4,31 @@ import pytest
 import salt.config
 
 
+@pytest.fixture(scope="session")
+def _minion_opts_template():  # pragma: no cover
+    """
+    Default minion configuration, shared by all tests.
+    """
+    return salt.config.DEFAULT_MINION_OPTS
+
+
+@pytest.fixture(scope="session")
+def _master_opts_template():  # pragma: no cover
+    """
+    Default master configuration, only loaded once as it is expensive to
+    compute. Nested values are shared, tests must not mutate them in place.
+    """
+    return salt.config.master_config(None)
+
+
 @pytest.fixture
-def minion_opts(tmp_path):  # pragma: no cover
+def minion_opts(tmp_path, _minion_opts_template):  # pragma: no cover
     """
     Default minion configuration with relative temporary paths to not
     require root permissions.
     """
     root_dir = tmp_path / "minion"
-    opts = salt.config.DEFAULT_MINION_OPTS.copy()
+    opts = _minion_opts_template.copy()
     opts["__role"] = "minion"
     opts["root_dir"] = str(root_dir)
     for name in ("cachedir", "pki_dir", "sock_dir", "conf_dir"):
@@ -24,13 +41,13 @@ def minion_opts(tmp_path):  # pragma: no cover
 
 
 @pytest.fixture
-def master_opts(tmp_path):  # pragma: no cover
+def master_opts(tmp_path, _master_opts_template):  # pragma: no cover
     """
     Default master configuration with relative temporary paths to not
     require root permissions.
     """
     root_dir = tmp_path / "master"
-    opts = salt.config.master_config(None)
+    opts = _master_opts_template.copy()
     opts["__role"] = "master"
     opts["root_dir"] = str(root_dir)
     for name in ("cachedir", "pki_dir", "sock_dir", "conf_dir"):
@@ -43,13 +60,13 @@ def master_opts(tmp_path):  # pragma: no cover
 
 
 @pytest.fixture
-def syndic_opts(tmp_path):  # pragma: no cover
+def syndic_opts(tmp_path, _minion_opts_template):  # pragma: no cover
     """
     Default master configuration with relative temporary paths to not
     require root permissions.
     """
     root_dir = tmp_path / "syndic"
-    opts = salt.config.DEFAULT_MINION_OPTS.copy()
+    opts = _minion_opts_template.copy()
     opts["syndic_master"] = "127.0.0.1"
     opts["__role"] = "minion"
     opts["root_dir"] = str(root_dir)